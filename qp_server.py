@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+QuickPlot render server: A local HTTP server that plots XD2006 grd files with
+the QuickPlot render pipeline and returns the plot as png, pdf or eps.
+
+Start the server from the command line:
+    python qp_server.py [port] [--par=FILE] [--workers=N] [--cache-mb=MB]
+                        [--max-upload-mb=MB]
+- port: Port on localhost to listen on (default 8765).
+- --par: Parameter file with the default parameters of all plots.
+- --workers: Number of processes rendering plots at the same time 
+             (default 4).
+- --cache-mb: Memory used for parsed grids and contour lines (default 512).
+- --max-upload-mb: Largest grd file accepted in a POST request (default 64).
+
+Requests:
+- GET /render?grd=PATH&...  plots the grd file PATH on the server.
+- POST /render?...          plots the grd file sent as the request body.
+The grd files can be gzip, bz2 or xz compressed.
+All other query arguments override parameters from the parameter file, e.g.
+    /render?grd=/data/xd_fou.grd&save_as=pdf&pos_lim=1.0&step=0.1
+The argument dpi sets the resolution (default 600 for png and raster_dpi for
+the rasterized layers of pdf and eps). Plots with more than 1000 contour
+levels or a resolution above 1200 dpi are not made.
+Invalid parameters or grd files are answered with status 400 and errors while
+plotting with status 500. The status line only has a fixed reason, the cause
+of the error is given in the response body.
+
+Atom colors and covalent radii (including 'change_atom_properties.txt') are
+read once at startup from the folder the server is started in. Parsed grids,
+traced contour lines and overlays are kept in a least recently used cache, so
+repeated requests for the same grid only pay for drawing and saving.
+Requests are read and parsed by a pool of threads, the plots are traced, 
+drawn and saved by a pool of processes (one matplotlib per process) that get
+the parsed grid and the cached contour lines and overlays with every plot.
+contour_tiles is ignored: every grid is traced serially by its process.
+
+Version tracking: Describe changes and update version number below section.
+0.2     Compressed grd files (gzip, bz2, xz) are accepted.
+0.3     Derived maps (derived=grad, lapl, neglapl) are cached per grid.
+0.4     Invalid parameters are answered with 400 and errors while plotting
+        with 500 instead of closing the connection.
+0.5     Overlays are kept in the cache entry of their grid instead of the
+        unbounded qp.overlay_cache.
+0.6     contour_tiles is ignored, the contours are always traced serially.
+0.7     Plots are rendered in a pool of processes (render_job) instead of the
+        request threads, so --workers plots are rendered in parallel.
+0.8     Errors are sent with a fixed reason in the status line and the cause
+        (escaped) in the body only (send_failure).
+0.9     Numbers that are not finite, more than max_levels contour levels and
+        a dpi or raster_dpi above max_dpi are answered with 400.
+1.0     A Content-Length that is not an integer or negative is answered with
+        400, uploads larger than --max-upload-mb with 413.
+1.1     step, pos_lim and neg_lim are only checked for linear contours and
+        pos_lim = 0 or neg_lim = 0 is accepted as in quickplot.py.
+"""
+version = 1.1
+
+################################################################################
+import os
+import sys
+
+import cgi
+import copy
+import hashlib
+import math
+import re
+import signal
+import StringIO
+import threading
+import collections
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import matplotlib
+matplotlib.use('Agg') # No windows are opened by the server
+import matplotlib.colors
+
+import quickplot as qp
+import xd_grd_lib as xd
+import atom_dictionary as atomdata
+################################################################################
+
+# Content type of the supported output formats
+content_types = {'png': 'image/png',
+                 'pdf': 'application/pdf',
+                 'eps': 'application/postscript'}
+
+# Reason phrase sent in the status line of the error responses
+reasons = {400: 'Invalid request',
+           404: 'Not found',
+           413: 'Request too large',
+           500: 'Plotting failed'}
+
+# Largest number of contour levels and resolution of a plot, the time to
+# render grows with both
+max_levels = 1000
+max_dpi = 1200
+
+# Line styles accepted for the contour lines
+line_styles = ('solid', 'dashed', 'dashdot', 'dotted', '-', '--', '-.', ':')
+
+# Atom colors and covalent radii of a render process (init_render_process)
+render_atoms = {}
+
+def get_version():
+    "Version tracking"""
+    return "qp_server: " + str(version)
+
+class GridCache(object):
+    """
+    Least recently used cache of parsed grids with a memory limit in bytes.
+    Every entry is a dictionary with the grid from qp.load_grid ('grid'),
+    the traced contour lines ('geometry', see qp.contour_geometry) and the
+    overlays of the grid ('overlays', see qp.get_overlay).
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the entry of key (and marks it as recently used) or None.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            entry = self.entries.pop(key)
+            self.entries[key] = entry
+            return entry
+
+    def put(self, key, entry):
+        """
+        Adds or updates an entry and removes the least recently used entries
+        until the cache is below the memory limit.
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            self.sizes[key] = entry_size(entry)
+            while sum(self.sizes.values()) > self.max_bytes and \
+                  len(self.entries) > 1:
+                old_key, old_entry = self.entries.popitem(last = False)
+                del self.sizes[old_key]
+
+def entry_size(entry):
+    """
+    Approximate memory used by a cache entry in bytes.
+    """
+    size = entry['grid'][6].nbytes
+    for segments in entry['geometry'].values():
+        for segment in segments:
+            size += segment.nbytes
+    # Roughly 100 bytes per bond, atom or label
+    for overlay in entry['overlays'].values():
+        for items in overlay.values():
+            size += 100*len(items)
+    return size
+
+def init_render_process(a_color, cov_r):
+    """
+    Sets up a render process: stores the atom properties and leaves
+    Ctrl-C to the server process.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    render_atoms['a_color'] = a_color
+    render_atoms['cov_r'] = cov_r
+
+def render_job(job):
+    """
+    Renders one plot in a render process. job is the grid, the parameters,
+    the cached contour lines and overlays and the resolution. Returns the
+    plot and the contour lines and overlays that were added.
+    """
+    grid, par, geometry, overlays, dpi = job
+    cached_levels = set(geometry)
+    cached_overlays = set(overlays)
+    plot = qp.render_bytes(grid, par, render_atoms['a_color'], \
+                           render_atoms['cov_r'], geometry, dpi, overlays)
+    geometry = dict([(level, segments) for level, segments \
+                     in geometry.items() if level not in cached_levels])
+    overlays = dict([(key, overlay) for key, overlay in overlays.items() \
+                     if key not in cached_overlays])
+    return plot, geometry, overlays
+
+def is_finite(value):
+    """
+    False for infinite values and nan.
+    """
+    return not (math.isinf(value) or math.isnan(value))
+
+def check_dpi(dpi, option = 'dpi'):
+    """
+    Raises ValueError if the resolution dpi is not positive or above max_dpi.
+    """
+    if not 0 < dpi <= max_dpi:
+        raise ValueError('%s must be positive and at most %d' % \
+                         (option, max_dpi))
+
+def parse_query(query, par):
+    """
+    Returns a copy of par updated with the parameters in the query
+    dictionary (from urlparse.parse_qs). Raises ValueError for unknown or
+    invalid parameters.
+    """
+    par = copy.deepcopy(par)
+    types = dict([(option, par_type) for section, option, par_type \
+                  in qp.par_types])
+    for option, values in query.items():
+        if option in ('grd', 'dpi'):
+            continue
+        if option not in types:
+            raise ValueError('Unknown parameter: %s' % option)
+        par[option] = qp.convert_parameter(values[-1], types[option])
+    for option, par_type in types.items():
+        if par_type == 'float' and not is_finite(par[option]):
+            raise ValueError('%s must be a finite number' % option)
+    if par['save_as'] not in content_types:
+        raise ValueError('Unknown format: %s' % par['save_as'])
+    if par['use_lin_contour']:
+        # pos_lim = 0 (neg_lim = 0) leaves out the positive (negative) levels
+        if par['step'] <= 0:
+            raise ValueError('step must be positive')
+        if not par['neg_lim'] <= 0 <= par['pos_lim']:
+            raise ValueError('neg_lim must not be positive and pos_lim not ' \
+                             'negative')
+        levels = (par['pos_lim'] - par['neg_lim'])/par['step']
+    else:
+        levels = 2*len(par['base'])*len(par['exponent'])
+        try:
+            qp.contour_levels(par)
+        except OverflowError:
+            raise ValueError('exponent is too large')
+    if not levels <= max_levels:
+        raise ValueError('More than %d contour levels' % max_levels)
+    check_dpi(par['raster_dpi'], 'raster_dpi')
+    # The render processes can not start the contour process pool, they
+    # already trace different grids in parallel
+    par['contour_tiles'] = 1
+    for option in ('pos_color', 'neg_color', 'zero_color', 'bond_color', \
+                   'label_color'):
+        if not matplotlib.colors.is_color_like(par[option]):
+            raise ValueError('Invalid color: %s=%s' % (option, par[option]))
+    for option in ('pos_line', 'neg_line', 'zero_line'):
+        if par[option] not in line_styles:
+            raise ValueError('Invalid line style: %s=%s' % \
+                             (option, par[option]))
+    return par
+
+class RenderHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handles GET and POST requests to /render.
+    """
+    def send_failure(self, code, detail):
+        """
+        Sends an error response. The status line only has the fixed reason
+        of the code (reasons), the detail may contain text from the request
+        and is only sent in the body, without line breaks and HTML escaped.
+        """
+        reason = reasons[code]
+        detail = cgi.escape(re.sub('[\r\n]+', ' ', detail), quote = True)
+        self.log_error('code %d, message %s', code, detail)
+        body = self.error_message_format % {'code': code, 'message': reason, \
+                                            'explain': detail}
+        self.send_response(code, reason)
+        self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path != '/render':
+            return self.send_failure(404, 'Unknown path: %s' % url.path)
+        if 'grd' not in query:
+            return self.send_failure(400, 'No grd file given')
+        filename = xd.find_grd(query['grd'][-1])
+        if filename is None:
+            return self.send_failure(404, '%s not found' % query['grd'][-1])
+        stat = os.stat(filename)
+        key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+        self.render(key, filename, query)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path != '/render':
+            return self.send_failure(404, 'Unknown path: %s' % url.path)
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+        except ValueError:
+            return self.send_failure(400, 'Invalid Content-Length')
+        if length < 0:
+            return self.send_failure(400, 'Invalid Content-Length')
+        if length == 0:
+            return self.send_failure(400, 'No grd file in request body')
+        if length > self.server.max_upload:
+            return self.send_failure(413, 'grd files are limited to %d bytes' \
+                                     % self.server.max_upload)
+        content = self.rfile.read(length)
+        key = ('upload', hashlib.sha1(content).hexdigest())
+        self.render(key, StringIO.StringIO(content), query)
+
+    def render(self, key, grd_file, query):
+        """
+        Plots the grid of grd_file (file name or file object) and sends the
+        plot. The parsed grid is looked up in the cache using key.
+        """
+        server = self.server
+        try:
+            par = parse_query(query, server.par)
+            dpi = None
+            if 'dpi' in query:
+                dpi = float(query['dpi'][-1])
+                check_dpi(dpi)
+        except ValueError as error:
+            return self.send_failure(400, str(error))
+        # Derived maps are cached separately from the grid they come from
+        derived = par['derived'].lower()
+        if derived not in ('none', 'grad', 'lapl', 'neglapl'):
+            return self.send_failure(400, 'Unknown derived map: %s' % derived)
+        key = key + (derived,)
+        entry = server.cache.get(key)
+        if entry is None:
+            source = server.cache.get(key[:-1] + ('none',))
+            if source is not None:
+                grid = source['grid']
+            else:
+                try:
+                    grid = qp.load_grid(grd_file)
+                except (ValueError, IndexError, IOError) as error:
+                    return self.send_failure(400, 'Not a valid grd file: ' \
+                                             + str(error))
+                if grid[0] != 2:
+                    return self.send_failure(400, 'Grid is not 2 dimensional')
+        # Errors while plotting are reported instead of closing the connection
+        try:
+            if entry is None:
+                entry = {'grid': qp.derive_grid(grid, par), 'geometry': {}, \
+                         'overlays': {}}
+            plot = server.render(entry, par, dpi)
+        except Exception as error:
+            return self.send_failure(500, str(error))
+        server.cache.put(key, entry)
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_types[par['save_as']])
+        self.send_header('Content-Length', str(len(plot)))
+        self.end_headers()
+        self.wfile.write(plot)
+
+class RenderServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP server that handles the requests in a pool of threads and renders
+    the plots in a pool of worker processes.
+    """
+    def __init__(self, address, workers, cache, par, a_color, cov_r, \
+                 max_upload):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RenderHandler)
+        # The processes are started before any thread, forking a process
+        # with running threads can deadlock
+        self.render_pool = multiprocessing.Pool(workers, \
+                           init_render_process, (a_color, cov_r))
+        # Twice as many threads, so requests are read while others render
+        self.pool = ThreadPool(2*workers)
+        self.cache = cache
+        self.par = par
+        # Largest request body in bytes
+        self.max_upload = max_upload
+
+    def render(self, entry, par, dpi):
+        """
+        Renders the grid of a cache entry in the process pool and returns the
+        plot. The cached contour lines of the levels in par and the overlays
+        are sent along, new ones are added to the entry.
+        """
+        levels = set([float(level) for contours in qp.contour_levels(par) \
+                      for level in contours])
+        geometry = dict([(level, segments) for level, segments \
+                         in entry['geometry'].items() if level in levels])
+        job = (entry['grid'], par, geometry, dict(entry['overlays']), dpi)
+        plot, geometry, overlays = self.render_pool.apply(render_job, (job,))
+        entry['geometry'].update(geometry)
+        entry['overlays'].update(overlays)
+        return plot
+
+    def process_request(self, request, client_address):
+        """
+        Handles the request in the worker pool instead of a new thread.
+        """
+        self.pool.apply_async(self.process_request_thread, \
+                              (request, client_address))
+
+################################################################################
+
+def main(argv):
+    qp.print_version()
+    print get_version() + '\n'
+
+    port = 8765
+    workers = 4
+    cache_mb = 512
+    max_upload_mb = 64
+    par = copy.deepcopy(qp.par)
+    for arg in argv[1:]:
+        if arg.startswith('--par='):
+            qp.read_parameters(arg.split('=', 1)[1], par)
+        elif arg.startswith('--workers='):
+            workers = int(arg.split('=', 1)[1])
+        elif arg.startswith('--cache-mb='):
+            cache_mb = float(arg.split('=', 1)[1])
+        elif arg.startswith('--max-upload-mb='):
+            max_upload_mb = float(arg.split('=', 1)[1])
+        else:
+            port = int(arg)
+
+    # Retrive atom colors and covalent radii
+    a_color = atomdata.get_atom_color()
+    cov_r = atomdata.get_covalent_radii()
+    a_color, cov_r = atomdata.change_atom_properties(a_color, cov_r)
+
+    cache = GridCache(int(cache_mb*1024*1024))
+    server = RenderServer(('127.0.0.1', port), workers, cache, par, \
+                          a_color, cov_r, int(max_upload_mb*1024*1024))
+    print 'Serving plots on http://127.0.0.1:%d/render' % port
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print '\nServer stopped.'
+    server.pool.terminate()
+    server.render_pool.terminate()
+    server.server_close()
+
+if __name__ == '__main__':
+    main(sys.argv)
+################################################################################
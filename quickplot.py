@@ -20,6 +20,32 @@ two arguments:
     
 If a 3D file is supplied the program exits.
 
+The grd files can be compressed with gzip, bz2 or xz (e.g. xd_fou.grd.gz), they
+are decompressed while reading. If 'xd_fou.grd' is not found 'xd_fou.grd.gz' 
+(.bz2, .xz) is used instead.
+
+Series mode: With the option --series all arguments are treated as grd files
+(e.g. a stack of planes or a refinement series) and a parameter file can be 
+given with --par=FILE (which can also replace the second argument of a single
+plot):
+    python quickplot.py --series xd_fou_1.grd xd_fou_2.grd --par=fou.par
+Unknown options are reported with a usage message.
+The figure, atoms and bonds are made once and only the contours are redrawn for
+each grid. Depending on 'series_as' in the [save] section every grid is saved 
+as a numbered frame or as a page in one multi-page pdf.
+
+With the option --make plots are only made again if the grd file, the 
+parameters, the atom properties or the QuickPlot version changed since the last
+run. The inputs of every plot are recorded in 'qp_manifest.json' in the cwd:
+    python quickplot.py xd_fou.grd fou.par --make
+
+With the option --interactive the grid is shown with sliders for the contour 
+levels (pos_lim, neg_lim and step, or the exponents of log contours) and 
+atom_cut. Press 'z' to toggle the zero contour and 'w' to write the current 
+settings to 'qp_interactive.par' (--interactive can not be
+combined with --series or --make):
+    python quickplot.py xd_fou.grd fou.par --interactive
+
 The parameter file can be edited to change the look of the plots. Remember to
 save the file under a new name as the program will overwrite it if no parameter
 file is specified.
@@ -52,8 +78,59 @@ Mads Ry Jørgensen, 2015, Aarhus University
 
 Version tracking: Describe changes and update version number below section. 
 Colors changed from tuples to single characters
+0.3     Plotting split into functions and parameters collected in the par 
+        dictionary. Added series mode (--series) that reuses one figure for 
+        many grids and only redraws the contours.
+0.4     Bonds, atoms and labels are computed once per plane and cached in 
+        memory and in the folder .qp_cache (get_overlay).
+0.5     Contours are drawn from traced line geometry (contour_geometry) that
+        can be reused. Added render_bytes used by the render server 
+        qp_server.py.
+0.6     gzip, bz2 and xz compressed grd files are accepted, e.g. xd_fou.grd.gz
+        is used if xd_fou.grd is not found.
+0.7     Contours, bonds and atoms can be rasterized in pdf/eps files 
+        (rasterize_* and raster_dpi in [save]).
+0.8     Gradient magnitude and Laplacian maps can be plotted from any grid 
+        (derived in the [function] section).
+0.9     Added --make: plots whose grd file, parameters, atom properties and
+        program version are unchanged since the last run are skipped 
+        (recorded in qp_manifest.json).
+1.0     Large grids can be contoured in parallel tiles (contour_tiles in 
+        [contours]).
+1.1     Added interactive mode (--interactive) with sliders for the contour 
+        levels and atom_cut. The settings can be written to a parameter file.
+1.2     Atoms, bonds and labels outside the plotted window are left out before
+        they are plotted (view_window).
+1.3     Overlays are only cached in memory, the .qp_cache folder is no longer
+        used.
+1.4     render_bytes draws and saves under render_lock, so it can be called 
+        from several threads. The overlay cache can be passed to it.
+1.5     Tiled contouring reuses one process pool (get_contour_pool) instead of
+        starting a new one for every plot. Interactive redraws trace serially.
+1.6     The exponent sliders of the interactive mode keep the exponents of the
+        parameter file, only exponents beyond them are added as a range.
+1.7     Interactive slider values are rounded relative to the slider range,
+        so small steps and limits are no longer rounded to 0.
+1.8     Unknown options are rejected with a usage message and --par=FILE is
+        also accepted for single plots.
+1.9     --make only compares the parameters that change the output 
+        (manifest_parameters), e.g. not contour_tiles or the raster options
+        of png files.
+2.0     The raster options are compared for the format a plot is saved in,
+        i.e. also for the pdf of a series when save_as is png.
+2.1     Rasterized layers are drawn as one image (raster_zorder) and the
+        rasterized contours of pdf and eps files without antialiasing.
+2.2     --interactive together with --series or --make is rejected with a
+        usage message instead of ignoring one of the options.
+2.3     The contours are traced before the pyplot figure is made, so the
+        contour process pool is never forked from a running GUI backend.
+2.4     Tiled contouring skips lines of a single vertex (levels equal to a
+        grid value) instead of failing while joining them.
+2.5     Tiled contour lines are joined without reversing them and closed
+        lines start at the same vertex as when traced serially, so dashed
+        lines look the same with and without tiles.
 """
-version = 0.2
+version = 2.5
 
 ################################################################################
 import os
@@ -62,9 +139,19 @@ import sys
 import itertools
 import re
 import ConfigParser
+import hashlib
+import StringIO
+import json
+import multiprocessing
+import threading
 
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.widgets import Slider
 
 import xd_grd_lib as xd
 import atom_dictionary as atomdata
@@ -106,331 +193,1220 @@ def parse_float_tuble(par_tup):
     """
     return tuple([float(i) for i in par_tup.strip('(').strip(')').split(',')])
 
-def create_qp_par():
+def create_qp_par(par_values = None, filename = 'qp.par'):
     """
-    Creates a qp.par file with default parameters 
+    Creates a qp.par file with default parameters. If par_values is given
+    (e.g. settings chosen in interactive mode) these values are written to
+    filename instead.
     """
-    qp_par = open('qp.par','w')
-    text = """# Feel free to remove items to have a shorter file, but do NOT
+    if par_values is None:
+        par_values = par
+    qp_par = open(filename,'w')
+    qp_par.write(qp_par_template % par_values)
+    qp_par.close()
+    print os.path.join(os.getcwd(), filename) + " created.\n"
+
+# Text of the parameter file, values are filled in by create_qp_par
+qp_par_template = """# Feel free to remove items to have a shorter file, but do NOT
 # remove the section headers (with [])!
 # Remember to rename file if edited!
 [contours]
 #Linear contours (FOU, DEF)
-use_lin_contour = True
-pos_lim = 2.0
-neg_lim = -2.0
-step = 0.05
+use_lin_contour = %(use_lin_contour)s
+pos_lim = %(pos_lim)s
+neg_lim = %(neg_lim)s
+step = %(step)s
 #Log contours (D2R) [base]*10**[exponent]
-base = [1, 2, 4, 8]
-exponent = [-2, -1, 0, 1, 2, 3, 4]
+base = %(base)s
+exponent = %(exponent)s
 # Show zero contour?
-zero_cont = False
+zero_cont = %(zero_cont)s
+# Split large grids in contour_tiles x contour_tiles parts that are contoured
+# in parallel (1: no splitting)
+contour_tiles = %(contour_tiles)s
+
+[function]
+# Plot a map derived from the grid: none, grad (|grad f|), lapl (Laplacian) or
+# neglapl (-Laplacian). Only in-plane derivatives are available for 2D grids.
+derived = %(derived)s
 
 [lines]
 #Colors and contour line styles:
 #b: blue, g: green, r: red, c: cyan, m: magenta, y: yellow, k: black, w: white
-pos_color = b
-pos_line = solid
-neg_color = r
-neg_line = dashed
-zero_color = k 
-zero_line = dotted
-cont_line_width = 0.8
+pos_color = %(pos_color)s
+pos_line = %(pos_line)s
+neg_color = %(neg_color)s
+neg_line = %(neg_line)s
+zero_color = %(zero_color)s
+zero_line = %(zero_line)s
+cont_line_width = %(cont_line_width)s
 
 [atoms]
-atom_size = 10
+atom_size = %(atom_size)s
 # Swich on/off symmetry generated atoms
-show_symm_atoms = True
+show_symm_atoms = %(show_symm_atoms)s
 # Cut-off for atoms out of plane:
-atom_cut = 0.2
+atom_cut = %(atom_cut)s
 
 [bonds]
-show_bonds = True
-bond_color = k
-bond_thickness = 2
+show_bonds = %(show_bonds)s
+bond_color = %(bond_color)s
+bond_thickness = %(bond_thickness)s
 #Bonds between symmetry generated atoms
-show_symm_bonds = True 
+show_symm_bonds = %(show_symm_bonds)s
 
 [labels]
-label_atoms = True
+label_atoms = %(label_atoms)s
 # Atoms has to be plotted to show label 
-label_symm_atoms = False 
-label_color = k
-label_size = 15
-label_x_offset = 0.1
-label_y_offset = 0.1
+label_symm_atoms = %(label_symm_atoms)s
+label_color = %(label_color)s
+label_size = %(label_size)s
+label_x_offset = %(label_x_offset)s
+label_y_offset = %(label_y_offset)s
 
 [save]
 # Save file as: png, eps, pdf
-save_as = png
+save_as = %(save_as)s
+# Series mode (--series): frames (one file per grid) or pdf (multi-page pdf)
+series_as = %(series_as)s
+# Rasterize layers in pdf/eps files with the resolution raster_dpi. Labels
+# are always vector graphics. Rasterized contours (with the bonds and atoms if
+# they are also rasterized) are drawn as one image without antialiasing, which
+# makes pdf files with many levels much smaller. eps files store the image
+# uncompressed (about 7 MB at 300 dpi, 4 times more at twice the dpi), they
+# are only smaller for very dense contours.
+rasterize_contours = %(rasterize_contours)s
+rasterize_bonds = %(rasterize_bonds)s
+rasterize_atoms = %(rasterize_atoms)s
+raster_dpi = %(raster_dpi)s
 """
-    qp_par.write(text)
-    qp_par.close()
-    print os.path.join(os.getcwd(),"qp.par") + " created.\n"
 
 ################################################################################
 # Set Default parameters    
 
+par = {
 #[contours]
 #Linear contours (FOU, DEF)
-use_lin_contour = True
-pos_lim = 2.0
-neg_lim = -2.0
-step = 0.05
+'use_lin_contour': True,
+'pos_lim': 2.0,
+'neg_lim': -2.0,
+'step': 0.05,
 #Log contours (D2R) [base]*10**[exponent]
-base = [1, 2, 4, 8]
-exponent = [-2, -1, 0, 1, 2, 3, 4]
+'base': [1, 2, 4, 8],
+'exponent': [-2, -1, 0, 1, 2, 3, 4],
 # Show zero contour?
-zero_cont = False
+'zero_cont': False,
+# Number of tiles along x and y for parallel contouring
+'contour_tiles': 1,
+
+#[function]
+# Derived map: 'none', 'grad', 'lapl' or 'neglapl'
+'derived': 'none',
 
 #[lines]
 #Colors and contour line styles:
-pos_color = 'b'
-pos_line = 'solid'
-neg_color = 'r'
-neg_line = 'dashed'
-zero_color = 'k' 
-zero_line = 'dotted'
-cont_line_width = 0.8
+'pos_color': 'b',
+'pos_line': 'solid',
+'neg_color': 'r',
+'neg_line': 'dashed',
+'zero_color': 'k',
+'zero_line': 'dotted',
+'cont_line_width': 0.8,
 
 #[atoms]
-atom_size = 10
+'atom_size': 10,
 # Swich on/off symmetry generated atoms
-show_symm_atoms = True
+'show_symm_atoms': True,
 # Cut-off for atoms out of plane:
-atom_cut = 0.2
+'atom_cut': 0.2,
 
 #[bonds]
-show_bonds = True
-bond_color = 'k'
-bond_thickness = 2
+'show_bonds': True,
+'bond_color': 'k',
+'bond_thickness': 2,
 #Bonds between symmetry generated atoms
-show_symm_bonds = True 
+'show_symm_bonds': True,
 
 #[labels]
-label_atoms = True
+'label_atoms': True,
 # Atoms has to be plotted to show label 
-label_symm_atoms = False 
-label_color = 'k'
-label_size = 15
-label_x_offset = 0.1
-label_y_offset = 0.1
+'label_symm_atoms': False,
+'label_color': 'k',
+'label_size': 15,
+'label_x_offset': 0.1,
+'label_y_offset': 0.1,
 
 #[save]
 # Save file as: 'png', 'eps', 'pdf'
-save_as = 'png'
+'save_as': 'png',
+# Series mode: 'frames' (one file per grid) or 'pdf' (one multi-page pdf)
+'series_as': 'frames',
+# Rasterize layers in 'pdf'/'eps' files with the resolution raster_dpi
+'rasterize_contours': False,
+'rasterize_bonds': False,
+'rasterize_atoms': False,
+'raster_dpi': 300,
+}
 
-################################################################################
-print_version()
+# Section, option and type of every entry in the parameter file
+par_types = [
+    ('contours', 'use_lin_contour', 'boolean'),
+    ('contours', 'pos_lim', 'float'),
+    ('contours', 'neg_lim', 'float'),
+    ('contours', 'step', 'float'),
+    ('contours', 'base', 'int_list'),
+    ('contours', 'exponent', 'int_list'),
+    ('contours', 'zero_cont', 'boolean'),
+    ('contours', 'contour_tiles', 'int'),
+    ('function', 'derived', 'string'),
+    ('lines', 'pos_color', 'string'),
+    ('lines', 'pos_line', 'string'),
+    ('lines', 'neg_color', 'string'),
+    ('lines', 'neg_line', 'string'),
+    ('lines', 'zero_color', 'string'),
+    ('lines', 'zero_line', 'string'),
+    ('lines', 'cont_line_width', 'float'),
+    ('atoms', 'atom_size', 'float'),
+    ('atoms', 'show_symm_atoms', 'boolean'),
+    ('atoms', 'atom_cut', 'float'),
+    ('bonds', 'show_bonds', 'boolean'),
+    ('bonds', 'bond_color', 'string'),
+    ('bonds', 'bond_thickness', 'float'),
+    ('bonds', 'show_symm_bonds', 'boolean'),
+    ('labels', 'label_atoms', 'boolean'),
+    ('labels', 'label_symm_atoms', 'boolean'),
+    ('labels', 'label_color', 'string'),
+    ('labels', 'label_size', 'float'),
+    ('labels', 'label_x_offset', 'float'),
+    ('labels', 'label_y_offset', 'float'),
+    ('save', 'save_as', 'string'),
+    ('save', 'series_as', 'string'),
+    ('save', 'rasterize_contours', 'boolean'),
+    ('save', 'rasterize_bonds', 'boolean'),
+    ('save', 'rasterize_atoms', 'boolean'),
+    ('save', 'raster_dpi', 'float'),
+    ]
 
-qp_par = None
-if len(sys.argv) <= 1:
-    if os.path.isfile('xd_fou.grd'):
-        print "No grd file given. Will use: 'xd_fou.grd'\n"
-        filename = 'xd_fou.grd'
-        print "No parameter file given.\nWill create qp.par and use standard parameters.\n"
-        create_qp_par()
-    else:
-        print "No grd file given.\nPlease specify grd file and the optional parameter file!\n"
-        sys.exit(0)
+# Accepted boolean values (as in ConfigParser)
+boolean_states = ConfigParser.RawConfigParser._boolean_states
+
+# Overlays (bonds, atoms and labels) of the planes plotted so far
+overlay_cache = {}
+# Held while drawing and saving in render_bytes: the Agg backend shares its
+# fonts between all figures of the process
+render_lock = threading.Lock()
+# Process pool of tiled_contour_geometry, started on first use
+contour_pool = None
+# File recording the inputs of all plots made with --make
+manifest_file = 'qp_manifest.json'
+# Printed for unknown options
+usage = """Usage:
+    python quickplot.py [grd file] [parameter file] [options]
+    python quickplot.py --series grd files [options]
+Options:
+    --par=FILE     Parameter file (instead of the second argument)
+    --series       Plot all grd files with the same parameters
+    --make         Only plot if the inputs changed since the last run
+    --interactive  Show the plot with sliders (not with --series or --make)"""
 
-if len(sys.argv) == 2:
-    if os.path.isfile(sys.argv[1]):
-        print sys.argv[1] + " found! No parameter file given.\nWill create qp.par and use standard parameters.\n"
-        filename = sys.argv[1]
-        qp_par = None
-        create_qp_par()
-    else:
-        print sys.argv[1] + " not found!\nPlease specify grd file and the optional parameter file!\n"
-        sys.exit(0)
-
-if len(sys.argv) >= 3:
-    if os.path.isfile(sys.argv[1]) and os.path.isfile(sys.argv[1]):
-        print sys.argv[1] + " and " + sys.argv[2] + " found!\n"
-        filename = sys.argv[1]
-        qp_par = sys.argv[2]
-    elif os.path.isfile(sys.argv[1]) and not os.path.isfile(sys.argv[2]):
-        print sys.argv[1] + "found!\n"
-        print sys.argv[2] + " not found!\nWill create qp.par and use standard parameters.\n"
-        create_qp_par()
-    else:
-        print sys.argv[1] + " not found!\nPlease specify grd file and the optional parameter file!\n"
-        sys.exit(0)
-        
 ################################################################################
-# Retrive atom colors and covalent radii
-a_color = atomdata.get_atom_color()
-cov_r = atomdata.get_covalent_radii()
-a_color, cov_r = atomdata.change_atom_properties(a_color, cov_r)
 
-# Update parameters based on parameter file
-if qp_par:
+def read_parameters(qp_par, par):
+    """
+    Updates the parameter dictionary par with the values found in the
+    parameter file qp_par. Options missing in the file keep their value.
+    """
     print "Raeding parameter values from " + qp_par + "..."
     config = ConfigParser.RawConfigParser()
     config.read(qp_par)
-    #contours
-    if config.has_option('contours','use_lin_contour'):
-        use_lin_contour = config.getboolean('contours','use_lin_contour')
-    if config.has_option('contours','pos_lim'):
-        pos_lim = config.getfloat('contours','pos_lim')
-    if config.has_option('contours','neg_lim'):
-        neg_lim = config.getfloat('contours','neg_lim')
-    if config.has_option('contours','step'):
-        step = config.getfloat('contours','step')
-    if config.has_option('contours','base'):
-        base = parse_int_list(config.get('contours','base'))
-    if config.has_option('contours','exponent'):
-        exponent = parse_int_list(config.get('contours','exponent'))
-    if config.has_option('contours','zero_cont'):
-        zero_cont = config.getboolean('contours','zero_cont')
-    #lines
-    if config.has_option('lines','pos_color'):
-        pos_color = config.get('lines','pos_color')
-    if config.has_option('lines','pos_line'):
-        pos_line = config.get('lines','pos_line')
-    if config.has_option('lines','neg_color'):
-        neg_color = config.get('lines','neg_color')
-    if config.has_option('lines','neg_line'):
-        neg_line = config.get('lines','neg_line')
-    if config.has_option('lines','zero_color'):
-        zero_color = config.get('lines','zero_color')
-    if config.has_option('lines','zero_line'):
-        zero_line = config.get('lines','zero_line')
-    if config.has_option('lines','cont_line_width'):
-        cont_line_width = config.getfloat('lines','cont_line_width')
-    #atoms
-    if config.has_option('atoms','atom_size'):
-        atom_size = config.getfloat('atoms','atom_size')
-    if config.has_option('atoms','show_symm_atoms'):
-        show_symm_atoms = config.getboolean('atoms','show_symm_atoms')
-    if config.has_option('atoms','atom_cut'):
-        atom_cut = config.getfloat('atoms','atom_cut')
-    #bonds
-    if config.has_option('bonds','show_bonds'):
-        show_bonds = config.getboolean('bonds','show_bonds')
-    if config.has_option('bonds','bond_color'):
-        bond_color = config.get('bonds','bond_color')
-    if config.has_option('bonds','bond_thickness'):
-        bond_thickness = config.getfloat('bonds','bond_thickness')
-    if config.has_option('bonds','show_symm_bonds'):
-        show_symm_bonds = config.getboolean('bonds','show_symm_bonds')
-    #labels
-    if config.has_option('labels','label_atoms'):
-        label_atoms = config.getboolean('labels','label_atoms')
-    if config.has_option('labels','label_symm_atoms'):
-        label_symm_atoms = config.getboolean('labels','label_symm_atoms')
-    if config.has_option('labels','label_color'):
-        label_color = config.get('labels','label_color')
-    if config.has_option('labels','label_size'):
-        label_size = config.getfloat('labels','label_size')
-    if config.has_option('labels','label_x_offset'):
-        label_x_offset = config.getfloat('labels','label_x_offset')
-    if config.has_option('labels','label_y_offset'):
-        label_y_offset = config.getfloat('labels','label_y_offset')
-    #save
-    if config.has_option('save','save_as'):
-        save_as = config.get('save','save_as')
+    for section, option, par_type in par_types:
+        if config.has_option(section, option):
+            par[option] = convert_parameter(config.get(section, option), \
+                                            par_type)
+    return par
+
+def convert_parameter(value, par_type):
+    """
+    Converts the string value of a parameter to the type par_type given in
+    par_types. Raises ValueError for invalid values.
+    """
+    if par_type == 'boolean':
+        if value.strip().lower() not in boolean_states:
+            raise ValueError('Not a boolean: %s' % value)
+        return boolean_states[value.strip().lower()]
+    elif par_type == 'float':
+        return float(value)
+    elif par_type == 'int':
+        return int(value)
+    elif par_type == 'int_list':
+        return parse_int_list(value)
+    else:
+        return value.strip()
+
+def atom_type(label):
+    """
+    Atomic symbol from an atom label, e.g. 'X1_Fe(4B)' to 'Fe'
+    """
+    return re.sub('.*?(_)', '', label).split('(')[0]
+
+def is_symm_atom(label):
+    """
+    True for symmetry generated atoms (labels starting with 'X')
+    """
+    return label[0] == 'X'
+
+def output_name(func, atoms, save_as):
+    """
+    File name of the plot, e.g. FOU_C(6A)C(8A)C(10A).png
+    """
+    return '%s_%s%s%s.%s' % (func, atoms[0][0], atoms[1][0], atoms[2][0], \
+                             save_as)
+
+def load_grid(filename):
+    """
+    Reads a grd file and moves the atoms to the plotting coordinates.
+    Returns the same as xd.read_xdgrd.
+    """
+    dim, func, x, y, z, atoms, data = xd.read_xdgrd(filename)
+    atoms = xd.clean_atoms(atoms, x[1], y[1], z[1])
+    return dim, func, x, y, z, atoms, data
+
+def derive_grid(grid, par):
+    """
+    Replaces the data of a grid loaded with load_grid by the derived map
+    par['derived'] ('grad', 'lapl' or 'neglapl'). The function name gets the
+    prefix GRAD_, LAPL_ or NEGLAPL_. Returns the grid unchanged for 'none'.
+    """
+    dim, func, x, y, z, atoms, data = grid
+    derived = par['derived'].lower()
+    if derived == 'none':
+        return grid
+    elif derived == 'grad':
+        data = xd.gradient_magnitude(data, x, y, z)
+    elif derived == 'lapl':
+        data = xd.laplacian(data, x, y, z)
+    elif derived == 'neglapl':
+        data = -1*xd.laplacian(data, x, y, z)
+    else:
+        raise ValueError('Unknown derived map: %s' % par['derived'])
+    return dim, derived.upper() + '_' + func, x, y, z, atoms, data
+
+def setup_figure(x, y, fig = None):
+    """
+    Creates the axes of a plot covering the plane described by x and y.
+    A new pyplot figure is made if fig is not given.
+    """
+    if fig is None:
+        fig = plt.figure()
+    ax = fig.add_subplot(111)
+    ax.set_aspect('equal')
+    set_plot_window(ax, x, y)
+    ax.set_xticks([])
+    ax.set_yticks([])
+    return fig, ax
+
+def set_plot_window(ax, x, y):
+    """
+    Limits the axes to the plane described by x and y. This also switches off
+    autoscaling so artists added later do not change the window.
+    """
+    ax.axis([x[3], x[4], y[3], y[4]])
+
+def contour_levels(par):
+    """
+    Returns the positive, negative and zero contour levels from the
+    [contours] parameters. The zero level list is empty if not shown.
+    """
+    if par['use_lin_contour']:
+        pos_contours, neg_contours = xd.linear_contour(\
+                                        par['step'], par['pos_lim'], \
+                                        par['neg_lim'])
+    else:
+        pos_contours, neg_contours = xd.log_contour(\
+                                        par['base'], par['exponent'])
+    zero_contours = [0.0] if par['zero_cont'] else []
+    return list(pos_contours), list(neg_contours), zero_contours
+
+def contour_geometry(xgrid, ygrid, data, levels, tiles = 1):
+    """
+    Traces the contour lines of data at the given levels. Returns a
+    dictionary level -> list of (N, 2) arrays with the line vertices.
+    With tiles > 1 the grid is split in tiles x tiles parts that are traced
+    in parallel (see tiled_contour_geometry).
+    """
+    if len(levels) == 0:
+        return {}
+    if tiles > 1:
+        return tiled_contour_geometry(xgrid, ygrid, data, levels, tiles)
+    # The contour set is made on a scratch axes that is never drawn
+    scratch = Figure().add_subplot(111)
+    contour_set = scratch.contour(xgrid, ygrid, data, levels = sorted(levels))
+    # Levels outside the data range have no lines
+    geometry = dict([(float(level), []) for level in levels])
+    for level, segments in zip(contour_set.levels, contour_set.allsegs):
+        if float(level) in geometry:
+            geometry[float(level)] = segments
+    return geometry
+
+def contour_tile(tile):
+    """
+    Traces the contour lines of one tile (xgrid, ygrid, data, levels).
+    Used by the process pool of tiled_contour_geometry.
+    """
+    xgrid, ygrid, data, levels = tile
+    return contour_geometry(xgrid, ygrid, data, levels)
+
+def get_contour_pool():
+    """
+    Returns the process pool used for tiled contouring. It is started the
+    first time it is needed and reused for all later plots.
+    """
+    global contour_pool
+    if contour_pool is None:
+        contour_pool = multiprocessing.Pool(multiprocessing.cpu_count())
+    return contour_pool
+
+def tiled_contour_geometry(xgrid, ygrid, data, levels, tiles):
+    """
+    Splits the grid in tiles x tiles parts, traces them in the process pool
+    (see get_contour_pool) and joins the lines that cross the tile borders.
+    Neighbouring tiles share one row of grid points, so every grid cell is
+    traced exactly once. The joined lines have the same vertices, direction,
+    first vertex and order as when tracing the whole grid, except where a
+    level equals grid values and lines run through grid points.
+    """
+    # Tile borders along x and y (at least two points per tile)
+    borders = [np.unique(np.linspace(0, n-1, tiles+1).astype(int)) \
+               for n in data.shape]
+    jobs = []
+    for i in range(len(borders[0])-1):
+        for j in range(len(borders[1])-1):
+            tile = (slice(borders[0][i], borders[0][i+1]+1), \
+                    slice(borders[1][j], borders[1][j+1]+1))
+            jobs.append((xgrid[tile], ygrid[tile], data[tile], levels))
+    results = get_contour_pool().map(contour_tile, jobs)
+    # Line ends closer than this are the same point
+    tolerance = 1e-6*min(abs(xgrid[1, 0]-xgrid[0, 0]), \
+                         abs(ygrid[0, 1]-ygrid[0, 0]))
+    geometry = {}
+    for level in levels:
+        segments = []
+        for result in results:
+            segments.extend(result[float(level)])
+        geometry[float(level)] = stitch_segments(segments, tolerance, \
+                                                 xgrid[:, 0], ygrid[0, :])
+    return geometry
+
+def stitch_segments(segments, tolerance, xs, ys):
+    """
+    Joins lines (arrays of vertices) whose ends meet into continuous lines as
+    traced on the whole grid with the coordinates xs (along the first axis)
+    and ys (along the second axis). A line is only continued by a line that
+    starts where it ends, so the direction of the lines is kept. Closed lines
+    start at the same vertex (see edge_key) and all lines come in the same
+    order as from matplotlib.
+    """
+    def point_key(point):
+        return (int(round(point[0]/tolerance)), int(round(point[1]/tolerance)))
+    # Closed lines need no joining
+    lines = []
+    open_lines = []
+    for segment in segments:
+        # Levels equal to a grid value give lines of a single vertex
+        if len(segment) < 2:
+            continue
+        if len(segment) > 2 and point_key(segment[0]) == point_key(segment[-1]):
+            lines.append(segment)
+        else:
+            open_lines.append(segment)
+    # Line start -> line, and the line continuing every line
+    starts = dict([(point_key(segment[0]), n) for n, segment \
+                   in enumerate(open_lines)])
+    following = [starts.get(point_key(segment[-1])) for segment in open_lines]
+    # Lines that continue no other line start at the border of the grid,
+    # the remaining lines form closed loops
+    heads = set(range(len(open_lines))) - set(following)
+    used = [False]*len(open_lines)
+    for first in sorted(heads) + range(len(open_lines)):
+        if used[first]:
+            continue
+        chain = []
+        n = first
+        while n is not None and not used[n]:
+            used[n] = True
+            chain.append(open_lines[n] if not chain else open_lines[n][1:])
+            n = following[n]
+        line = np.concatenate(chain)
+        if n is not None:
+            # Closed loop: start it at the same vertex as matplotlib does
+            line = line[:-1]
+            keys = [edge_key(point, xs, ys, tolerance) for point in line]
+            k = keys.index(min(keys))
+            line = np.concatenate([line[k:], line[:k+1]])
+        lines.append(line)
+    # Open lines first, each group ordered by the grid cell of the first
+    # line segment
+    def line_order(line):
+        closed = len(line) > 2 and point_key(line[0]) == point_key(line[-1])
+        middle = (line[0] + line[1])/2
+        return (closed, np.searchsorted(xs, middle[0]), \
+                np.searchsorted(ys, middle[1]))
+    lines.sort(key = line_order)
+    return lines
+
+def edge_key(point, xs, ys, tolerance):
+    """
+    Grid edge of a contour vertex as (index along the first axis, index along
+    the second axis, 0 for edges along the second axis and 1 for edges along
+    the first axis). matplotlib starts closed lines at the vertex with the
+    smallest key.
+    """
+    i = np.searchsorted(xs, point[0] - tolerance)
+    j = np.searchsorted(ys, point[1] - tolerance)
+    if i < len(xs) and abs(xs[i] - point[0]) <= tolerance:
+        return (i, j - 1, 0)
+    return (i - 1, j, 1)
+
+def plot_contour_geometry(ax, geometry, levels, color, line, width):
+    """
+    Plots the traced contour lines of the given levels as one line
+    collection. Returns the collection.
+    """
+    segments = []
+    for level in levels:
+        segments.extend(geometry.get(float(level), []))
+    contours = LineCollection(segments, colors = color, linestyles = line, \
+                              linewidths = width, zorder = 2)
+    ax.add_collection(contours, autolim = False)
+    return contours
+
+def trace_contours(xgrid, ygrid, data, par, geometry):
+    """
+    Traces the contour levels of par that are not yet in the dictionary
+    geometry (see contour_geometry) and adds them to it.
+    Returns the positive, negative and zero levels.
+    """
+    pos_contours, neg_contours, zero_contours = contour_levels(par)
+    missing = [level for level in pos_contours + neg_contours + \
+               zero_contours if float(level) not in geometry]
+    geometry.update(contour_geometry(xgrid, ygrid, data, missing, \
+                                     par['contour_tiles']))
+    return pos_contours, neg_contours, zero_contours
+
+def plot_contours(ax, xgrid, ygrid, data, par, geometry = None, \
+                  save_as = None):
+    """
+    Plots the positive, negative and (optionally) zero contours.
+    Traced levels found in the dictionary geometry (see contour_geometry) are
+    reused and new ones are added to it. save_as is the format the plot is
+    saved in: rasterized contours of pdf and eps files are drawn without
+    antialiasing.
+    Returns a list of the line collections so they can be removed again.
+    """
+    if geometry is None:
+        geometry = {}
+    pos_contours, neg_contours, zero_contours = trace_contours(xgrid, ygrid, \
+                                                   data, par, geometry)
+    contours = []
+    contours.append(plot_contour_geometry(ax, geometry, pos_contours, \
+                    par['pos_color'], par['pos_line'], \
+                    par['cont_line_width']))
+    contours.append(plot_contour_geometry(ax, geometry, neg_contours, \
+                    par['neg_color'], par['neg_line'], \
+                    par['cont_line_width']))
+    if zero_contours:
+        contours.append(plot_contour_geometry(ax, geometry, zero_contours, \
+                        par['zero_color'], par['zero_line'], \
+                        par['cont_line_width']))
+    # Without antialiasing the contour image has few distinct colors and
+    # compresses several times better
+    if par['rasterize_contours'] and save_as in ('pdf', 'eps'):
+        for collection in contours:
+            collection.set_antialiased(False)
+    ax.set_rasterization_zorder(raster_zorder(par))
+    return contours
+
+def raster_zorder(par):
+    """
+    Rasterization zorder of the axes: the rasterized layers below the first
+    vector layer (contours at zorder 2, bonds at 2.1 and atoms at 2.2) are
+    drawn as one image. None if the contours are not rasterized.
+    """
+    zorder = None
+    layers = [('rasterize_contours', 2), ('rasterize_bonds', 2.1), \
+              ('rasterize_atoms', 2.2)]
+    for option, layer in layers:
+        if not par[option]:
+            break
+        zorder = layer + 0.05
+    return zorder
+
+def overlay_key(atoms, par, a_color, cov_r, window = None):
+    """
+    Cache key of the atom/bond/label overlay of a plane: a hash of the atom
+    list, the [atoms], [bonds] and [labels] parameters, the colors and
+    radii of the elements present and the plotted window.
+    """
+    types = sorted(set([atom_type(atom[0]) for atom in atoms]))
+    key = [atoms]
+    key.append([(option, par[option]) for section, option, par_type \
+                in par_types if section in ('atoms', 'bonds', 'labels')])
+    key.append([(t, a_color.get(t), cov_r.get(t)) for t in types])
+    key.append(window)
+    return hashlib.sha1(repr(key)).hexdigest()
+
+def view_window(ax, x, y):
+    """
+    Returns the plotted window (xmin, xmax, ymin, ymax) and the size of one
+    point (1/72 inch) in plot coordinates. Used by compute_overlay to skip
+    atoms, bonds and labels that can not be seen.
+    """
+    ax.apply_aspect()
+    fig = ax.get_figure()
+    position = ax.get_position()
+    width = position.width*fig.get_figwidth()*72
+    height = position.height*fig.get_figheight()*72
+    point = max((x[4]-x[3])/width, (y[4]-y[3])/height)
+    return (x[3], x[4], y[3], y[4], round(float(point), 9))
+
+def in_window(xmin, xmax, ymin, ymax, window, margin = 0):
+    """
+    True if the box xmin..xmax, ymin..ymax overlaps the window (see
+    view_window) enlarged by margin.
+    """
+    return xmax >= window[0]-margin and xmin <= window[1]+margin and \
+           ymax >= window[2]-margin and ymin <= window[3]+margin
+
+def segment_in_window(p1, p2, window, margin = 0):
+    """
+    True if the line from p1 to p2 crosses the window (see view_window)
+    enlarged by margin (Liang-Barsky clipping).
+    """
+    t0, t1 = 0.0, 1.0
+    dx = p2[0] - p1[0]
+    dy = p2[1] - p1[1]
+    for p, q in [(-dx, p1[0] - (window[0]-margin)),
+                 (dx, (window[1]+margin) - p1[0]),
+                 (-dy, p1[1] - (window[2]-margin)),
+                 (dy, (window[3]+margin) - p1[1])]:
+        if p == 0:
+            if q < 0: # Parallel to and outside this edge
+                return False
+        elif p < 0:
+            t0 = max(t0, float(q)/p)
+        else:
+            t1 = min(t1, float(q)/p)
+        if t0 > t1:
+            return False
+    return True
+
+def compute_overlay(atoms, par, a_color, cov_r, window = None):
+    """
+    Finds the bonds, atom markers and labels to be plotted on top of the
+    contours. Returns a dictionary with the lists:
+    'bonds': ((x1, y1), (x2, y2)), 'atoms': (x, y, color) and
+    'labels': (x, y, label)
+    If the plotted window is given (see view_window) bonds, atoms and labels
+    outside it are left out.
+    """
+    overlay = {'bonds': [], 'atoms': [], 'labels': []}
+    # Include only atoms near plane
+    near = [atom for atom in atoms if abs(atom[3]) <= par['atom_cut']]
+    if window is not None:
+        point = window[4]
+        # Half the marker (incl. edge) and half the bond line width
+        atom_margin = (par['atom_size'] + par['bond_thickness'])/2.0*point
+        bond_margin = par['bond_thickness']/2.0*point
+        # Bonds can only reach the window from atoms closer than the
+        # longest possible bond
+        longest = 2*max([cov_r.get(atom_type(atom[0]), 0) for atom in near] \
+                        + [0])
+        bonded = [atom for atom in near if in_window(atom[1], atom[1], \
+                  atom[2], atom[2], window, longest + bond_margin)]
+    else:
+        bonded = near
+    if par['show_bonds']:
+        # Itterate over all pairs of atoms near the plane
+        for pair in itertools.combinations(bonded, 2):
+            l1, x1, y1, z1 = pair[0]
+            l2, x2, y2, z2 = pair[1]
+            # Plot only bonds in asym unit
+            if not par['show_symm_bonds'] and \
+               (is_symm_atom(l1) or is_symm_atom(l2)):
+                continue
+            dist = np.sqrt((x2-x1)**2 + (y2-y1)**2 + (z2-z1)**2)
+            # Plot if distance is smaller than sum of covalent radii
+            if dist > cov_r.get(atom_type(l1), 0) + \
+                      cov_r.get(atom_type(l2), 0):
+                continue
+            if window is None or segment_in_window((x1, y1), (x2, y2), \
+                                                   window, bond_margin):
+                overlay['bonds'].append(((x1, y1), (x2, y2)))
+    for label, xa, ya, za in near:
+        # Show only asym unit
+        if not par['show_symm_atoms'] and is_symm_atom(label):
+            continue
+        if window is None or in_window(xa, xa, ya, ya, window, atom_margin):
+            overlay['atoms'].append((xa, ya, a_color.get(atom_type(label), \
+                                                         (0, 0, 0))))
+        # Atoms has to be plotted to show label
+        if par['label_atoms'] and \
+           (par['label_symm_atoms'] or not is_symm_atom(label)):
+            xl = xa + par['label_x_offset']
+            yl = ya + par['label_y_offset']
+            # Generous text box: one font size per character, starting at
+            # the baseline
+            if window is not None:
+                size = par['label_size']*point
+                if not in_window(xl, xl + len(label)*size, yl - size/2, \
+                                 yl + size, window):
+                    continue
+            overlay['labels'].append((xl, yl, label))
+    return overlay
+
+def get_overlay(atoms, par, a_color, cov_r, window = None, cache = None):
+    """
+    Returns the overlay of the plane from the cache, or computes and caches
+    it. Grids of the same plane (FOU, DEF, D2R, ...) plotted in one run or
+    series share it. cache is a dictionary (default overlay_cache) and
+    window is passed on to compute_overlay.
+    """
+    if cache is None:
+        cache = overlay_cache
+    key = overlay_key(atoms, par, a_color, cov_r, window)
+    if key not in cache:
+        cache[key] = compute_overlay(atoms, par, a_color, cov_r, window)
+    return cache[key]
+
+def plot_overlay(ax, overlay, par):
+    """
+    Plots bonds, atoms and labels of an overlay on top of the contours.
+    Returns a list of the artists so they can be removed again.
+    """
+    artists = []
+    # Layers below the rasterization zorder are already in the contour image
+    zorder = raster_zorder(par) or 0
+    if overlay['bonds']:
+        bonds = LineCollection(overlay['bonds'], linewidths = \
+                               par['bond_thickness'], colors = \
+                               par['bond_color'], zorder = 2.1)
+        bonds.set_rasterized(par['rasterize_bonds'] and zorder < 2.1)
+        ax.add_collection(bonds, autolim = False)
+        artists.append(bonds)
+    # One line object per atom color
+    colors = []
+    for xa, ya, color in overlay['atoms']:
+        if color not in colors:
+            colors.append(color)
+    for color in colors:
+        xs = [atom[0] for atom in overlay['atoms'] if atom[2] == color]
+        ys = [atom[1] for atom in overlay['atoms'] if atom[2] == color]
+        artists.extend(ax.plot(xs, ys, linestyle = 'None', marker='o', \
+                               mec = (0,0,0), mew = par['bond_thickness'], \
+                               mfc = color, ms = par['atom_size'], \
+                               zorder = 2.2, rasterized = \
+                               par['rasterize_atoms'] and zorder < 2.2))
+    for xl, yl, label in overlay['labels']:
+        artists.append(ax.text(xl, yl, label, fontsize = par['label_size'], \
+                               color = par['label_color'], clip_on=True))
+    return artists
+
+def remove_artists(artists):
+    """
+    Removes artists, e.g. the contours made by plot_contours or the bonds,
+    atoms and labels made by plot_overlay.
+    """
+    for artist in artists:
+        artist.remove()
+
+def draw_plot(fig, grid, par, a_color, cov_r, geometry = None, \
+              overlays = None):
+    """
+    Draws contours, bonds, atoms and labels of a grid loaded with load_grid
+    in the figure fig. Returns the axes. overlays is the overlay cache passed
+    to get_overlay.
+    """
+    dim, func, x, y, z, atoms, data = grid
+    xgrid, ygrid = xd.plot_area(x, y, z)
+    fig, ax = setup_figure(x, y, fig)
+    plot_contours(ax, xgrid, ygrid, data, par, geometry, par['save_as'])
+    plot_overlay(ax, get_overlay(atoms, par, a_color, cov_r, \
+                                 window = view_window(ax, x, y), \
+                                 cache = overlays), par)
+    return ax
+
+def output_dpi(par, save_as):
+    """
+    Resolution used when saving. In pdf and eps files it only applies to the
+    rasterized layers.
+    """
+    if save_as in ('pdf', 'eps'):
+        return par['raster_dpi']
+    return 600
+
+def render_bytes(grid, par, a_color, cov_r, geometry = None, dpi = None, \
+                 overlays = None):
+    """
+    Plots a grid loaded with load_grid without pyplot and returns the file
+    content in the format par['save_as'] as a string. The contours are traced
+    first, drawing and saving is done holding render_lock, so calls from
+    several threads only run one at a time. overlays is the overlay cache
+    passed to get_overlay.
+    """
+    if dpi is None:
+        dpi = output_dpi(par, par['save_as'])
+    if geometry is None:
+        geometry = {}
+    dim, func, x, y, z, atoms, data = grid
+    xgrid, ygrid = xd.plot_area(x, y, z)
+    trace_contours(xgrid, ygrid, data, par, geometry)
+    with render_lock:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+        draw_plot(fig, grid, par, a_color, cov_r, geometry, overlays)
+        output = StringIO.StringIO()
+        fig.savefig(output, format = par['save_as'], bbox_inches='tight', \
+                    pad_inches=0, dpi = dpi)
+    return output.getvalue()
+
+def file_hash(filename):
+    """
+    sha1 hash of the content of a file
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), ''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def manifest_parameters(par, save_as):
+    """
+    The parameters that change the output of a plot saved in the format 
+    save_as, as hashed in the manifest. Left out are contour_tiles (the lines
+    are the same), series_as (part of the target), the raster options of png
+    files and the options of parts that are not shown (log or linear levels,
+    zero contour, bonds, labels).
+    """
+    skip = ['contour_tiles', 'series_as']
+    if save_as not in ('pdf', 'eps'):
+        skip += ['rasterize_contours', 'rasterize_bonds', 'rasterize_atoms', \
+                 'raster_dpi']
+    if par['use_lin_contour']:
+        skip += ['base', 'exponent']
+    else:
+        skip += ['pos_lim', 'neg_lim', 'step']
+    if not par['zero_cont']:
+        skip += ['zero_color', 'zero_line']
+    if not par['show_bonds']:
+        # bond_thickness is also the edge width of the atoms
+        skip += ['bond_color', 'show_symm_bonds']
+    if not par['label_atoms']:
+        skip += ['label_symm_atoms', 'label_color', 'label_size', \
+                 'label_x_offset', 'label_y_offset']
+    return dict([(option, value) for option, value in par.items() \
+                 if option not in skip])
+
+def plot_inputs(filenames, target, par, a_color, cov_r, save_as = None):
+    """
+    Everything a plot depends on, as stored in the manifest: the grd files
+    and hashes of their content, the parameters (see manifest_parameters),
+    the atom properties and the program versions. target names the kind of
+    output, e.g. 'plot' or 'frame 003', and save_as the format it is saved
+    in (default par['save_as']).
+    """
+    if save_as is None:
+        save_as = par['save_as']
+    atom_properties = [sorted(a_color.items()), sorted(cov_r.items())]
+    parameters = manifest_parameters(par, save_as)
+    return {'target': '%s %s %s' % (target, par['derived'].lower(), save_as),
+            'grd': [os.path.abspath(filename) for filename in filenames],
+            'grd_hash': [file_hash(filename) for filename in filenames],
+            'par_hash': hashlib.sha1(json.dumps(parameters, \
+                                     sort_keys = True)).hexdigest(),
+            'atom_hash': hashlib.sha1(json.dumps(atom_properties)).hexdigest(),
+            'version': ', '.join(['quickplot: ' + str(version), \
+                                  xd.get_version(), atomdata.get_version()])}
+
+def read_manifest():
+    """
+    Reads the manifest (output -> inputs) from manifest_file in the cwd.
+    """
+    if not os.path.isfile(manifest_file):
+        return {}
+    try:
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        print manifest_file + " is not readable. All plots will be made.\n"
+        return {}
+
+def write_manifest(manifest):
+    """
+    Writes the manifest to manifest_file in the cwd.
+    """
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+
+def check_manifest(manifest, inputs):
+    """
+    Compares the inputs of a plot with the manifest. Returns the output file
+    and the reason to make it again (None if the output is up to date).
+    """
+    for output, entry in manifest.items():
+        if entry['target'] != inputs['target'] or \
+           entry['grd'] != inputs['grd']:
+            continue
+        if not os.path.isfile(output):
+            return output, 'output missing'
+        for field, reason in [('grd_hash', 'grd file changed'),
+                              ('par_hash', 'parameters changed'),
+                              ('atom_hash', 'atom properties changed'),
+                              ('version', 'QuickPlot version changed')]:
+            if entry[field] != inputs[field]:
+                return output, reason
+        return output, None
+    return None, 'new plot'
+
+def is_up_to_date(manifest, inputs):
+    """
+    Prints whether a plot is up to date or why it is made again.
+    """
+    output, reason = check_manifest(manifest, inputs)
+    if reason is None:
+        print '%s is up to date.' % output
+        return True
+    print 'Making plot of %s: %s.' % (', '.join(inputs['grd']), reason)
+    return False
+
+def update_manifest(manifest, output, inputs):
+    """
+    Records the inputs of a saved plot and writes the manifest.
+    """
+    for old_output, entry in manifest.items():
+        if entry['target'] == inputs['target'] and \
+           entry['grd'] == inputs['grd']:
+            del manifest[old_output]
+    manifest[output] = inputs
+    write_manifest(manifest)
+
+def render(filename, par, a_color, cov_r, manifest = None):
+    """
+    Plots a single 2D grd file and saves the plot in the cwd.
+    If a manifest is given (see read_manifest) the plot is only made if its
+    inputs have changed.
+    """
+    if manifest is not None:
+        inputs = plot_inputs([filename], 'plot', par, a_color, cov_r)
+        if is_up_to_date(manifest, inputs):
+            return
+    grid = load_grid(filename)
+    # Check dimensionality of plot
+    if grid[0] != 2:
+        print "Grid is not 2 dimensional. Please specify a 2D grid!"
+        sys.exit()
+    grid = derive_grid(grid, par)
+    dim, func, x, y, z, atoms, data = grid
+
+    # The contours are traced before pyplot starts the GUI backend, so the
+    # process pool of tiled contouring is not forked from it
+    geometry = {}
+    xgrid, ygrid = xd.plot_area(x, y, z)
+    trace_contours(xgrid, ygrid, data, par, geometry)
+    fig = plt.figure()
+    draw_plot(fig, grid, par, a_color, cov_r, geometry)
+
+    name = output_name(func, atoms, par['save_as'])
+    fig.savefig(name, bbox_inches='tight', pad_inches=0, dpi = \
+                output_dpi(par, par['save_as']))
+    print '%s saved in %s/' % (name, os.getcwd())
+    if manifest is not None:
+        update_manifest(manifest, name, inputs)
+    plt.show()
+
+def render_series(filenames, par, a_color, cov_r, manifest = None):
+    """
+    Plots a series of 2D grd files (e.g. a stack of planes or a refinement
+    series) in one figure. The axes, atoms and bonds are only drawn again when
+    the plane changes; for all other grids only the contours are replaced.
+    Every grid is saved as a numbered frame or as a page of one pdf file
+    depending on par['series_as']. If a manifest is given (see read_manifest)
+    only frames, or the pdf, with changed inputs are made.
+    """
+    save_as = 'pdf' if par['series_as'] == 'pdf' else par['save_as']
+    if manifest is not None and par['series_as'] == 'pdf':
+        inputs = plot_inputs(filenames, 'series', par, a_color, cov_r, \
+                             save_as)
+        if is_up_to_date(manifest, inputs):
+            return
+    fig = None
+    ax = None
+    plane = None
+    overlay_artists = []
+    contours = []
+    pdf = None
+    for frame, filename in enumerate(filenames):
+        if manifest is not None and par['series_as'] != 'pdf':
+            inputs = plot_inputs([filename], 'frame %03d' % (frame+1), par, \
+                                 a_color, cov_r)
+            if is_up_to_date(manifest, inputs):
+                continue
+        grid = load_grid(filename)
+        if grid[0] != 2:
+            print filename + " is not 2 dimensional. Skipped!"
+            continue
+        dim, func, x, y, z, atoms, data = derive_grid(grid, par)
+        # Traced before the first figure is made (see render)
+        geometry = {}
+        xgrid, ygrid = xd.plot_area(x, y, z)
+        trace_contours(xgrid, ygrid, data, par, geometry)
+        if ax is None:
+            fig, ax = setup_figure(x, y)
+        remove_artists(contours)
+        # Atoms and bonds are shared by all grids of the same plane
+        set_plot_window(ax, x, y)
+        overlay = get_overlay(atoms, par, a_color, cov_r, \
+                              window = view_window(ax, x, y))
+        if plane is not overlay:
+            remove_artists(overlay_artists)
+            overlay_artists = plot_overlay(ax, overlay, par)
+            plane = overlay
+        contours = plot_contours(ax, xgrid, ygrid, data, par, geometry, \
+                                 save_as)
+        if par['series_as'] == 'pdf':
+            if pdf is None:
+                name = output_name(func, atoms, 'pdf')[:-4] + '_series.pdf'
+                pdf = PdfPages(name)
+            pdf.savefig(fig, bbox_inches='tight', pad_inches=0, dpi = \
+                        output_dpi(par, 'pdf'))
+            print '%s added to %s' % (filename, name)
+        else:
+            name = output_name(func, atoms, par['save_as'])
+            name = '%s_%03d.%s' % (name[:-len(par['save_as'])-1], frame+1, \
+                                   par['save_as'])
+            fig.savefig(name, bbox_inches='tight', pad_inches=0, dpi = \
+                        output_dpi(par, par['save_as']))
+            print '%s saved in %s/' % (name, os.getcwd())
+            if manifest is not None:
+                update_manifest(manifest, name, inputs)
+    if pdf is not None:
+        pdf.close()
+        print '%s saved in %s/' % (name, os.getcwd())
+        if manifest is not None:
+            update_manifest(manifest, name, inputs)
+    if fig is not None:
+        plt.close(fig)
+
+def interactive(filename, par, a_color, cov_r):
+    """
+    Shows a 2D grd file with sliders for the contour levels and atom_cut.
+    The grid, the traced contour lines of every level and the overlays are
+    kept in memory, so moving a slider only traces new levels and redraws.
+    Keys: 'z' toggles the zero contour, 'w' writes the current settings to
+    qp_interactive.par.
+    """
+    grid = load_grid(filename)
+    if grid[0] != 2:
+        print "Grid is not 2 dimensional. Please specify a 2D grid!"
+        sys.exit()
+    dim, func, x, y, z, atoms, data = derive_grid(grid, par)
+    xgrid, ygrid = xd.plot_area(x, y, z)
+
+    # Traced before the figure is made (see render)
+    geometry = {}
+    trace_contours(xgrid, ygrid, data, par, geometry)
+    fig = plt.figure()
+    fig, ax = setup_figure(x, y, fig)
+    fig.subplots_adjust(bottom = 0.3)
+    window = view_window(ax, x, y)
+    artists = {'contours': plot_contours(ax, xgrid, ygrid, data, par, \
+                                         geometry),
+               'overlay': plot_overlay(ax, get_overlay(atoms, par, \
+                                       a_color, cov_r, window = window), \
+                                       par)}
+
+    def redraw_contours():
+        remove_artists(artists['contours'])
+        # The few new levels of a slider move are traced faster serially
+        # than in tiles
+        artists['contours'] = plot_contours(ax, xgrid, ygrid, data, \
+                                            dict(par, contour_tiles = 1), \
+                                            geometry)
+        fig.canvas.draw_idle()
+
+    def redraw_overlay():
+        remove_artists(artists['overlay'])
+        artists['overlay'] = plot_overlay(ax, get_overlay(atoms, par, \
+                                          a_color, cov_r, window = window), \
+                                          par)
+        fig.canvas.draw_idle()
+
+    def set_parameter(option, redraw, integer = False, positive = False):
+        """
+        Returns a slider callback that sets par[option] and redraws. With
+        positive, values <= 0 are ignored.
+        """
+        def update(value):
+            if integer:
+                value = int(round(value))
+            if positive and value <= 0:
+                return
+            par[option] = value
+            redraw()
+        return update
+
+    # Exponents of the parameter file and the range set by the sliders
+    exponents = sorted(par['exponent'])
+    exponent_range = [exponents[0], exponents[-1]]
+
+    def set_exponent(index):
+        """
+        Returns a slider callback for the lowest (index 0) or highest
+        (index -1) exponent of the log contours. Exponents of the parameter
+        file inside the range are kept (also if not contiguous), the range
+        beyond them is filled with every exponent.
+        """
+        def update(value):
+            exponent_range[index] = int(round(value))
+            low, high = exponent_range
+            exponent = range(low, min(exponents[0], high+1)) + \
+                       [e for e in exponents if low <= e <= high] + \
+                       range(max(exponents[-1]+1, low), high+1)
+            # A range between two exponents of the file can be empty
+            if exponent:
+                par['exponent'] = exponent
+                redraw_contours()
+        return update
+
+    sliders = []
+    def add_slider(label, valmin, valmax, valinit, update):
+        slider_ax = fig.add_axes([0.25, 0.22-0.05*len(sliders), 0.5, 0.03])
+        slider = Slider(slider_ax, label, valmin, valmax, valinit = valinit)
+        # Values are rounded to about a thousandth of the slider range
+        digits = 3 - int(np.floor(np.log10(max(valmax - valmin, 1e-12))))
+        slider.on_changed(lambda value: update(round(value, digits)))
+        sliders.append(slider)
+
+    if par['use_lin_contour']:
+        add_slider('pos_lim', 0, max(par['pos_lim'], float(data.max())), \
+                   par['pos_lim'], set_parameter('pos_lim', redraw_contours))
+        add_slider('neg_lim', min(par['neg_lim'], float(data.min())), 0, \
+                   par['neg_lim'], set_parameter('neg_lim', redraw_contours))
+        add_slider('step', par['step']/10, par['step']*10, par['step'], \
+                   set_parameter('step', redraw_contours, positive = True))
+    else:
+        low, high = exponent_range
+        add_slider('lowest exponent', low-3, high+3, low, set_exponent(0))
+        add_slider('highest exponent', low-3, high+3, high, set_exponent(-1))
+    max_cut = max([abs(atom[3]) for atom in atoms] + [par['atom_cut']])
+    add_slider('atom_cut', 0, max_cut, par['atom_cut'], \
+               set_parameter('atom_cut', redraw_overlay))
+
+    def on_key(event):
+        if event.key == 'z':
+            par['zero_cont'] = not par['zero_cont']
+            redraw_contours()
+        elif event.key == 'w':
+            create_qp_par(par, 'qp_interactive.par')
+    fig.canvas.mpl_connect('key_press_event', on_key)
+
+    print "Move the sliders to change contours and atom_cut."
+    print "Press 'z' to toggle the zero contour and 'w' to write the settings"
+    print "to qp_interactive.par.\n"
+    plt.show()
 
 ################################################################################
-                
-# Dimensions for plot, and atoms
-dim, func, x, y, z, atoms, data = xd.read_xdgrd(filename)
-atoms = xd.clean_atoms(atoms, x[1], y[1], z[1])
-
-# Check dimensionality of plot
-if dim != 2:
-    print "Grid is not 2 dimensional. Please specify a 2D grid!"
-    sys.exit()
-
-# Contours
-if use_lin_contour:
-    pos_contours, neg_contours = xd.linear_contour(\
-                                    step, pos_lim, neg_lim)
-else:
-    pos_contours, neg_contours = xd.log_contour(\
-                                    base, exponent)
-
-xgrid, ygrid = xd.plot_area(x, y, z)
-
-# Plot contours
-plt.contour(xgrid, ygrid, data, levels = pos_contours, colors = \
-            pos_color, linestyles = pos_line, linewidths = \
-            cont_line_width)
-plt.contour(xgrid, ygrid, data, levels = neg_contours, colors = \
-            neg_color, linestyles = neg_line, linewidths = \
-            cont_line_width)
-if zero_cont:
-    plt.contour(xgrid, ygrid, data, levels = [0], colors = \
-                zero_color, linestyles = zero_line, \
-                linewidths = cont_line_width)
-
-plt.axes().set_aspect('equal')
-
-if show_bonds:                
-    # Itterate over all pairs of atoms in the file
-    for pair in itertools.combinations(atoms, 2):
-        l1, x1, y1, z1 = pair[0]
-        l1, x2, y2, z2 = pair[1]
-        dist = np.sqrt((x2-x1)**2 + (y2-y1)**2 + (z2-z1)**2)
-        a_type1 = re.sub('.*?(_)', '', pair[0][0]).split('(')[0]
-        a_type2 = re.sub('.*?(_)', '', pair[1][0]).split('(')[0]
-        if abs(float(pair[0][3])) <= atom_cut: # Include only atoms near plane
-                if abs(float(pair[1][3])) <= atom_cut:
-                # Plot if distance is smaller than sum of covalent radii         
-                    if dist <= cov_r.get(a_type1, 0) + \
-                                cov_r.get(a_type2, 0):
-                        if show_symm_bonds: # Plot all bonds
-                            plt.plot([x1,x2], [y1, y2], linewidth = \
-                                        bond_thickness, color = \
-                                        bond_color)
-                        # Plot only bonds in asym unit
-                        if not show_symm_bonds: 
-                            if pair[0][0][0] != 'X' and pair[1][0][0] \
-                                != 'X':
-                                plt.plot([x1,x2], [y1, y2], linewidth =\
-                                            bond_thickness, color = \
-                                            bond_color)
-                                            
-# Plot atoms 
-for atom in atoms:
-    if abs(float(atom[3])) <= atom_cut:
-        if show_symm_atoms: # Show all atoms
-            a_type = re.sub('.*?(_)', '', atom[0]).split('(')[0]
-            plt.plot(atom[1], atom[2], marker='o', \
-                    mec = (0,0,0), mew = bond_thickness, \
-                    mfc = a_color.get(a_type, (0, 0, 0)), ms = \
-                            atom_size)
-            if label_atoms:
-                if label_symm_atoms: # Label all atoms
-                    plt.text(atom[1]+label_x_offset, atom[2] + \
-                                label_y_offset, atom[0], fontsize = \
-                                label_size, color = label_color,\
-                                clip_on=True)
-                if not label_symm_atoms: # Only label asym unit
-                    if atom[0][0] != 'X':
-                        plt.text(atom[1]+label_x_offset, atom[2] +\
-                                    label_y_offset, atom[0], fontsize\
-                                    = label_size, color = \
-                                    label_color, clip_on=True)
-        if not show_symm_atoms: # Show only asym unit
-                if atom[0][0] != 'X':
-                    a_type = re.sub('.*?(_)', '', atom[0]).split('(')[0]
-                    plt.plot(atom[1], atom[2], marker='o', mec = \
-                                (0,0,0), mew = bond_thickness, mfc = \
-                                a_color.get(a_type, (0, 0, 0)), ms = \
-                                atom_size)
-                    if label_atoms: # Label all atoms (in asym unit)
-                        plt.text(atom[1]+label_x_offset, atom[2] +\
-                                    label_y_offset, atom[0], fontsize\
-                                    = label_size, color = \
-                                    label_color, clip_on=True)
-                                            
-plt.axis([x[3], x[4], y[3], y[4]])
-plt.xticks([])
-plt.yticks([])                                          
-plt.savefig('%s_%s%s%s.%s' % (func, atoms[0][0], atoms[1][0], \
-            atoms[2][0], save_as), bbox_inches='tight', pad_inches=0, dpi = 600)
-print '%s_%s%s%s.%s saved in %s/' % (func, atoms[0][0], atoms[1][0], \
-      atoms[2][0], save_as, os.getcwd())
-plt.show()
+
+def main(argv):
+    print_version()
+
+    # Options start with '--', everything else are file names
+    options = [arg for arg in argv[1:] if arg.startswith('--')]
+    args = [arg for arg in argv[1:] if not arg.startswith('--')]
+    for option in options:
+        if option not in ('--series', '--make', '--interactive') and \
+           not option.startswith('--par='):
+            print "Unknown option: " + option + "\n"
+            print usage
+            sys.exit(0)
+    # --interactive only shows a single plot and saves nothing
+    for option in ('--series', '--make'):
+        if option in options and '--interactive' in options:
+            print option + " can not be used with --interactive\n"
+            print usage
+            sys.exit(0)
+    series = '--series' in options
+    manifest = None
+    if '--make' in options:
+        manifest = read_manifest()
+
+    # A parameter file can be given with --par=FILE in both modes
+    qp_par = None
+    for option in options:
+        if option.startswith('--par='):
+            qp_par = option.split('=', 1)[1]
+
+    if series:
+        # All arguments are grd files
+        filenames = [xd.find_grd(arg) for arg in args if xd.find_grd(arg)]
+        for arg in args:
+            if not xd.find_grd(arg):
+                print arg + " not found! Skipped."
+        if len(filenames) == 0:
+            print "No grd files given.\nPlease specify the grd files of the series!\n"
+            sys.exit(0)
+
+    if not series and len(args) == 0:
+        if xd.find_grd('xd_fou.grd'):
+            filename = xd.find_grd('xd_fou.grd')
+            print "No grd file given. Will use: '" + filename + "'\n"
+        else:
+            print "No grd file given.\nPlease specify grd file and the optional parameter file!\n"
+            sys.exit(0)
+
+    if not series and len(args) >= 1:
+        filename = xd.find_grd(args[0])
+        if filename:
+            print filename + " found!"
+        else:
+            print args[0] + " not found!\nPlease specify grd file and the optional parameter file!\n"
+            sys.exit(0)
+        if len(args) >= 2:
+            if qp_par is not None:
+                print "Two parameter files given: " + args[1] + " and " + \
+                      qp_par + "\n"
+                print usage
+                sys.exit(0)
+            qp_par = args[1]
+        if len(args) > 2:
+            print "Ignored: " + " ".join(args[2:])
+
+    if qp_par is None:
+        print "No parameter file given.\nWill create qp.par and use standard parameters.\n"
+        create_qp_par()
+    elif os.path.isfile(qp_par):
+        print qp_par + " found!\n"
+    else:
+        print qp_par + " not found!\nWill create qp.par and use standard parameters.\n"
+        qp_par = None
+        create_qp_par()
+
+    ############################################################################
+    # Retrive atom colors and covalent radii
+    a_color = atomdata.get_atom_color()
+    cov_r = atomdata.get_covalent_radii()
+    a_color, cov_r = atomdata.change_atom_properties(a_color, cov_r)
+
+    # Update parameters based on parameter file
+    if qp_par:
+        read_parameters(qp_par, par)
+
+    if series:
+        render_series(filenames, par, a_color, cov_r, manifest)
+    elif '--interactive' in options:
+        interactive(filename, par, a_color, cov_r)
+    else:
+        render(filename, par, a_color, cov_r, manifest)
+
+if __name__ == '__main__':
+    main(sys.argv)
 ################################################################################
@@ -17,13 +17,36 @@ Version tracking: Describe changes and update version number below section.
         from e.g. ADDGRID. Simplified the expression to calculate coordinates 
         for plotting. For 3D four the data are apparently listed differently 
         than from xdprop - fix for this has been implemented(January 27th 2014)
+0.5     read_xdgrd() also accepts an open file object.
+0.6     read_xdgrd() reads gzip, bz2 and xz compressed grd files (open_grd) 
+        and fills the data array line by line instead of building a list.
+        Added find_grd().
+0.7     Added gradient_magnitude() and laplacian() for derived maps computed
+        with finite differences (slab by slab for 3D grids).
+0.8     bz2 compressed file objects are decompressed chunk by chunk (BZ2Lines)
+        and read_xdgrd() closes the file it opened also on errors.
+0.9     read_xdgrd() raises ValueError for files that end before the grid
+        or the values instead of reading past the end forever.
+1.0     bz2 compressed files are also read with BZ2Lines from disk, so files
+        with several streams (pbzip2, lbzip2) are read completely.
 """
-version = 0.4
+version = 1.0
 
 ################################################################################
 
+import os
+import gzip
+import bz2
+
 import numpy as np
 import copy
+try:
+    import lzma # xz compressed grd files
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 ################################################################################
 
@@ -31,63 +54,180 @@ def get_version():
     "Version tracking"""
     return "xd_grd_lib: " + str(version)
 
+def find_grd(file):
+    """
+    Returns the name of the grd file, or of a compressed version of it (e.g. 
+    xd_fou.grd.gz for xd_fou.grd) if only that exists. None if not found.
+    """
+    for name in [file, file+'.gz', file+'.bz2', file+'.xz']:
+        if os.path.isfile(name):
+            return name
+    return None
+
+class BZ2Lines(object):
+    """
+    Reads the lines of a bz2 compressed file object, decompressing one chunk
+    at a time. Files with several streams (e.g. from pbzip2 or lbzip2) are 
+    read to the end, BZ2File in Python 2 stops after the first stream.
+    With close_file the file object is closed by close().
+    """
+    def __init__(self, file, chunk_size = 1024*1024, close_file = False):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.close_file = close_file
+        self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = ''
+        self.position = 0
+
+    def read_chunk(self):
+        """
+        Adds the next decompressed chunk to the buffer. Returns False at the
+        end of the file.
+        """
+        data = self.file.read(self.chunk_size)
+        if not data:
+            return False
+        text = []
+        while data:
+            try:
+                text.append(self.decompressor.decompress(data))
+            except EOFError: # The last stream ended with the previous chunk
+                self.decompressor = bz2.BZ2Decompressor()
+                continue
+            data = self.decompressor.unused_data
+            if data: # Start of the next stream
+                self.decompressor = bz2.BZ2Decompressor()
+        self.buffer = self.buffer[self.position:] + ''.join(text)
+        self.position = 0
+        return True
+
+    def readline(self):
+        """
+        Returns the next line including the newline, '' at the end of the file.
+        """
+        end = self.buffer.find('\n', self.position)
+        while end < 0:
+            searched = len(self.buffer) - self.position
+            if not self.read_chunk():
+                line = self.buffer[self.position:]
+                self.position = len(self.buffer)
+                return line
+            end = self.buffer.find('\n', searched)
+        line = self.buffer[self.position:end+1]
+        self.position = end + 1
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        """
+        Drops the buffer and closes the file object if close_file was given.
+        """
+        self.buffer = ''
+        self.position = 0
+        if self.close_file:
+            self.file.close()
+
+def open_grd(file):
+    """
+    Opens a grd file for reading. gzip, bz2 and xz compressed files are 
+    recognized by their first bytes and decompressed on the fly.
+    file can be a file name or an open file object (e.g. an upload).
+    """
+    if hasattr(file, 'readline'):
+        magic = file.read(6)
+        file.seek(0)
+    else:
+        with open(file, 'rb') as grd_file:
+            magic = grd_file.read(6)
+    if magic.startswith('\x1f\x8b'):
+        if hasattr(file, 'readline'):
+            return gzip.GzipFile(fileobj = file, mode = 'rb')
+        return gzip.GzipFile(file, 'rb')
+    elif magic.startswith('BZh'):
+        if hasattr(file, 'readline'):
+            return BZ2Lines(file)
+        return BZ2Lines(open(file, 'rb'), close_file = True)
+    elif magic == '\xfd7zXZ\x00':
+        if lzma is None:
+            raise IOError('Reading xz compressed files needs the lzma module')
+        return lzma.LZMAFile(file, 'r')
+    elif hasattr(file, 'readline'):
+        return file
+    return open(file, 'r')
+
 def read_xdgrd(file):
     """
     Read grd file from XD2006
     Returns dimension, function, number of points in xyz, origin and dimensions,
     min and max, atoms (label, x, y, z) and an numpy array with the data
+    file can be a file name or an open file object (e.g. an upload), both 
+    possibly compressed (see open_grd).
     """
-    grd_file = open(file, 'r')
-
-    # Read header and save dimension of file and function
-    line = grd_file.readline()
-    dim = int(line[0])
-    line = grd_file.readline()
+    grd_file = open_grd(file)
     try:
-        func = line.split()[-1]
-    except IndexError: # If no function is listed, e.g. from ADDGRID
-        func = 'NONE'
-    line = grd_file.readline()
-    while line[0:6] != '! Grid':
+        # Read header and save dimension of file and function
+        line = grd_file.readline()
+        if not line:
+            raise ValueError('Empty grd file')
+        dim = int(line[0])
         line = grd_file.readline()
-    # Read dimensions of grid
-    nx, ny, nz = grd_file.readline().split()
-    xo, yo, zo = grd_file.readline().split()
-    xdim, ydim, zdim = grd_file.readline().split()
-    x = (int(nx), float(xo), float(xdim), float(xo)-float(xdim)/2, \
-         float(xo)+float(xdim)/2)
-    y = (int(ny), float(yo), float(ydim), float(yo)-float(ydim)/2, \
-         float(yo)+float(ydim)/2)
-    z = (int(nz), float(zo), float(zdim), float(zo)-float(zdim)/2, \
-         float(zo)+float(zdim)/2)
-    # Store number of atoms
-    line = grd_file.readline()
-    n_atoms = int(grd_file.readline().split()[0])
-    # Read atoms and collect in list of lists
-    atoms = []
-    for i in range(n_atoms):
-        atoms.append(grd_file.readline().split()[0:4])
-    # Read until data begins
-    while line[0:8] != '! Values':
+        try:
+            func = line.split()[-1]
+        except IndexError: # If no function is listed, e.g. from ADDGRID
+            func = 'NONE'
         line = grd_file.readline()
-    # Read rest of file into a long list of points
-    data = []
-    lines = grd_file.readlines()
-    for line in lines:
-        for point in line.split():
-            data.append(float(point))
-    # Convert to np array and reshape
+        while line[0:6] != '! Grid':
+            if not line:
+                raise ValueError('No grid dimensions in grd file')
+            line = grd_file.readline()
+        # Read dimensions of grid
+        nx, ny, nz = grd_file.readline().split()
+        xo, yo, zo = grd_file.readline().split()
+        xdim, ydim, zdim = grd_file.readline().split()
+        x = (int(nx), float(xo), float(xdim), float(xo)-float(xdim)/2, \
+             float(xo)+float(xdim)/2)
+        y = (int(ny), float(yo), float(ydim), float(yo)-float(ydim)/2, \
+             float(yo)+float(ydim)/2)
+        z = (int(nz), float(zo), float(zdim), float(zo)-float(zdim)/2, \
+             float(zo)+float(zdim)/2)
+        # Store number of atoms
+        line = grd_file.readline()
+        n_atoms = int(grd_file.readline().split()[0])
+        # Read atoms and collect in list of lists
+        atoms = []
+        for i in range(n_atoms):
+            atoms.append(grd_file.readline().split()[0:4])
+        # Read until data begins
+        while line[0:8] != '! Values':
+            if not line:
+                raise ValueError('No values in grd file')
+            line = grd_file.readline()
+        # Read rest of file line by line into an array of the final size
+        data = np.empty(x[0]*y[0]*z[0], dtype = 'float32')
+        n = 0
+        for line in grd_file:
+            points = np.fromstring(line, dtype = 'float32', sep = ' ')
+            if n + len(points) > len(data):
+                raise ValueError('More values than grid points in grd file')
+            data[n:n+len(points)] = points
+            n += len(points)
+        if n != len(data):
+            raise ValueError('Found %d values for %d grid points' % \
+                             (n, len(data)))
+    finally:
+        if grd_file is not file:
+            grd_file.close()
+    # Reshape
     if dim == 2:
-        data = np.array(data, dtype = 'float32')
         data = data.reshape(y[0], x[0])
 #ORIGINAL        data = data.reshape(x[0], y[0])
         data = np.swapaxes(data, 0, 1)
     elif dim == 3 and func == 'FOU':
-        data = np.array(data, dtype = 'float32')
         data = data.reshape(x[0], y[0], z[0])
         # DO NOT SWAP AXES!
     else:
-        data = np.array(data, dtype = 'float32')
         data = data.reshape(x[0], y[0], z[0])
         # Swap x and z, more intuitive with x, y, z
         data = np.swapaxes(data, 0, 2)
@@ -191,3 +331,76 @@ def crop_atoms3d(atoms, crop_range, x, y, z):
             cropped_atoms.append(atom)
     return cropped_atoms
     
+
+def grid_spacing(x, y, z):
+    """
+    Distance between grid points along x, y and z (as used in plot_area).
+    """
+    return tuple([float(d[2])/int(d[0]) for d in (x, y, z)])
+
+def derivative(data, axis, h, order = 1):
+    """
+    First or second derivative of data along axis with grid spacing h.
+    Central differences inside the grid and second order one-sided 
+    differences at the edges, so the result has the same shape as data.
+    Needs at least 3 (first) or 4 (second derivative) points along axis.
+    """
+    f = np.swapaxes(data.astype('float64'), axis, 0)
+    d = np.empty(f.shape)
+    if order == 1:
+        d[1:-1] = (f[2:] - f[:-2])/(2*h)
+        d[0] = (-3*f[0] + 4*f[1] - f[2])/(2*h)
+        d[-1] = (3*f[-1] - 4*f[-2] + f[-3])/(2*h)
+    else:
+        d[1:-1] = (f[2:] - 2*f[1:-1] + f[:-2])/h**2
+        d[0] = (2*f[0] - 5*f[1] + 4*f[2] - f[3])/h**2
+        d[-1] = (2*f[-1] - 5*f[-2] + 4*f[-3] - f[-4])/h**2
+    return np.swapaxes(d, 0, axis)
+
+def slabwise(function, data, slab = 16):
+    """
+    Applies function to a 3D array slab by slab along the last axis to limit
+    the memory used. Every slab is padded with neighbouring points so 
+    derivatives (see derivative) are the same as for the whole array.
+    2D arrays are passed to function directly.
+    """
+    if data.ndim == 2:
+        return function(data).astype('float32')
+    n = data.shape[2]
+    result = np.empty(data.shape, dtype = 'float32')
+    for start in range(0, n, slab):
+        stop = min(start+slab, n)
+        # One point padding, at least 4 points for one-sided differences
+        lo = max(start-1, 0)
+        hi = min(stop+1, n)
+        lo = max(min(lo, hi-4), 0)
+        hi = min(max(hi, lo+4), n)
+        block = function(data[:, :, lo:hi])
+        result[:, :, start:stop] = block[:, :, start-lo:stop-lo]
+    return result
+
+def gradient_magnitude(data, x, y, z, slab = 16):
+    """
+    Returns |grad f| of a 2D or 3D grid from read_xdgrd. For 2D grids only the
+    in-plane components are available.
+    """
+    h = grid_spacing(x, y, z)
+    def magnitude(block):
+        square = np.zeros(block.shape)
+        for axis in range(block.ndim):
+            square += derivative(block, axis, h[axis])**2
+        return np.sqrt(square)
+    return slabwise(magnitude, data, slab)
+
+def laplacian(data, x, y, z, slab = 16):
+    """
+    Returns the Laplacian of a 2D or 3D grid from read_xdgrd. For 2D grids 
+    only the in-plane curvatures (d2f/dx2 + d2f/dy2) are available.
+    """
+    h = grid_spacing(x, y, z)
+    def curvature(block):
+        total = np.zeros(block.shape)
+        for axis in range(block.ndim):
+            total += derivative(block, axis, h[axis], 2)
+        return total
+    return slabwise(curvature, data, slab)